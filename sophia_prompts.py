@@ -0,0 +1,153 @@
+"""Sophia's static prompt and pattern data.
+
+Kept out of new.py, which Streamlit re-executes on every interaction, so the
+prompts, system messages and compiled regexes below are built exactly once
+per process. Mappings are read-only views; never mutate the message dicts.
+"""
+import json
+import re
+from types import MappingProxyType
+from typing import Final
+
+# ── Prompts 
+# Every agent's system prompt starts with the same preamble, byte for byte, so
+# Groq's automatic prefix caching can reuse it across all four agents. Keep
+# these constant: no timestamps or per-user text in system prompts.
+SHARED_PREAMBLE: Final = """OHC Pharmacy patient assistant team (Sophia and her specialists).
+You are chatting with a patient or caregiver. Keep replies short and plain,
+ask one question at a time, and never invent prices, links, or policies
+beyond those given in your role below.
+
+"""
+
+GENERAL_PROMPT: Final = SHARED_PREAMBLE + """You are Sophia, the Master Assistant for OHC Pharmacy.
+Answer general pharmacy questions in a friendly, concise way.
+"""
+
+CGM_PROMPT: Final = SHARED_PREAMBLE + """You are the CGM Specialist for OHC Pharmacy.
+Strict flow (one step at a time):
+1) Greeting & ID → Ask for full name and DOB.
+2) Insurance → Ask about insurance (Medicare/Medicaid/commercial). If none, explain cash-pay.
+3) Clinical → diabetes dx, insulin use, testing frequency, hypoglycemia, last A1c, doctor name.
+4) Rx & Medical Necessity → ask for photos; if not available, offer doctor outreach / telehealth link.
+5) Expectations → Rx + medical necessity needed before compliance packet & shipment.
+6) Delivery → ask for address & phone.
+7) If hesitant → offer call/appointment.
+Tone: empathetic, supportive, short confirmations.
+"""
+
+WEIGHT_PROMPT: Final = SHARED_PREAMBLE + """You are the Weight Loss Specialist.
+Strict flow (stepwise, concise):
+1) Prior use → Ask if patient used semaglutide or tirzepatide.
+2) Program & Cost → cash-pay starts at $149; telehealth visit is free.
+3) Rx status → If Rx, ask for photo or doctor send. If no Rx, share telehealth link: https://landing.xpedicare.com/#/widget/d6t4
+4) Telehealth steps → choose med (injection/sublingual), create account, questions, upload ID + full-body photo, doctor review.
+5) After approval → pickup (free) or delivery ($20/$30).
+6) If hesitant → offer call/appointment.
+7) Common Qs → sema vs tirze, B12, injections vs sublingual, ~5min telehealth, uploads required.
+Tone: friendly, simple, conversational.
+"""
+
+DME_PROMPT: Final = SHARED_PREAMBLE + """You are the General DME Specialist (Texas-compliant).
+Strict flow (concise):
+1) Greeting & ID → ask for name and DOB.
+2) Identify item → ask what equipment is needed.
+3) Insurance → ask if they have insurance; if yes collect details; if no explain cash-pay.
+4) Prescription rules (Texas):
+   - Always Rx: CPAP, oxygen, CGM, power/custom wheelchairs, hospital beds, spinal braces.
+   - Insurance needs Rx; cash doesn’t: walkers, canes, shower chairs, off-the-shelf braces, compression 20–30mmHg.
+   - Cash only: OTC supplies, comfort aids, low-compression stockings.
+   If Rx missing → offer telehealth.
+5) Clinical → condition, doctor, prior use, mobility aids.
+6) Expectations → insurance requires Rx + medical necessity before compliance packet & shipment.
+7) Delivery → ask for address and phone.
+8) If hesitant → offer call/appointment.
+Tone: empathetic, supportive, clear.
+"""
+
+# System messages are built once and the same dict is placed at the head of
+# every request, so no per-call allocation and their JSON is encoded once
+# (see _cache_key in new.py). Never mutate them.
+SYSTEM_MSG_GENERAL: Final = {"role": "system", "content": GENERAL_PROMPT}
+SYSTEM_MSG_CGM: Final = {"role": "system", "content": CGM_PROMPT}
+SYSTEM_MSG_WEIGHT: Final = {"role": "system", "content": WEIGHT_PROMPT}
+SYSTEM_MSG_DME: Final = {"role": "system", "content": DME_PROMPT}
+
+SYSTEM_MSGS: Final = MappingProxyType({
+    "general": SYSTEM_MSG_GENERAL,
+    "cgm": SYSTEM_MSG_CGM,
+    "weight": SYSTEM_MSG_WEIGHT,
+    "dme": SYSTEM_MSG_DME,
+})
+
+# Canonical JSON of each system message, keyed by id() because _cache_key in
+# new.py sees the same dict objects. This has to live here: new.py is
+# re-executed on every Streamlit rerun, while this module is imported once per
+# process, so the prompts are encoded exactly once.
+SYSTEM_MSG_JSON: Final = MappingProxyType(
+    {id(m): json.dumps(m, sort_keys=True).encode() for m in SYSTEM_MSGS.values()}
+)
+
+
+# ── Intent patterns 
+# Intent keyword patterns, kept as source strings for readability and fused
+# into one alternation below so classification is a single regex pass.
+CGM_PATTERN = (
+    r"cgms?|continuous\s+glucose\s+monitors?|glucose\s+monitors?|blood\s+sugar|dexcom|freestyle\s*-?\s*libre"
+)
+
+WEIGHT_PATTERN = r"weight[-\s]*loss|semaglutide|tirzepatide|ozempic|wegovy"
+
+DME_PATTERN = (
+    r"blood\s*pressure\s*monitors?|bp\s*monitors?|"
+    r"walkers?|wheelchairs?|"
+    r"shower\s*chairs?|bath\s*-?\s*bench(?:es)?|commodes?|"
+    r"hospital\s*beds?|"
+    r"dme|medical\s*equipment"
+)
+
+RGX_INTENT = re.compile(
+    "|".join(
+        [
+            rf"\b(?P<cgm>{CGM_PATTERN})\b",
+            rf"\b(?P<weight>{WEIGHT_PATTERN})\b",
+            rf"\b(?P<dme>{DME_PATTERN})\b",
+        ]
+    )
+)
+
+RGX_GREET = re.compile(r"^\s*(hi|hello|hey|salam|salaam|assalamualaikum|as-?salamu ?alaykum)\s*!*\.?$")
+
+# One named group per kind of small talk; SMALLTALK_REPLIES is keyed by m.lastgroup.
+RGX_SMALLTALK = re.compile(
+    r"^\s*(?:(?P<thanks>thanks|thank you|thank you so much|thx|ty)"
+    r"|(?P<ack>ok|okay|k|cool|great|got it)"
+    r"|(?P<bye>bye|goodbye))\s*[!.]*$"
+)
+
+SMALLTALK_REPLIES: Final = MappingProxyType({
+    "thanks": "You're welcome! Is there anything else I can help you with?",
+    "ack": "Great! What can I help you with today?",
+    "bye": "Goodbye! Take care, and come back any time.",
+})
+
+# Same vocabulary as the patterns above, for the Aho–Corasick matcher. Runs of
+# whitespace/hyphens collapse to one space before matching; every phrase is
+# also added with each space optionally removed.
+INTENT_KEYWORDS: Final = MappingProxyType({
+    "cgm": (
+        "cgm", "cgms", "continuous glucose monitor", "continuous glucose monitors",
+        "glucose monitor", "glucose monitors", "blood sugar", "dexcom", "freestyle libre",
+    ),
+    "weight": ("weight loss", "semaglutide", "tirzepatide", "ozempic", "wegovy"),
+    "dme": (
+        "blood pressure monitor", "blood pressure monitors", "bp monitor", "bp monitors",
+        "walker", "walkers", "wheelchair", "wheelchairs",
+        "shower chair", "shower chairs", "bath bench", "bath benches", "commode", "commodes",
+        "hospital bed", "hospital beds",
+        "dme", "medical equipment",
+    ),
+})
+
+RGX_KEYWORD_SPACE = re.compile(r"[\s-]+")
+RGX_SPACE = re.compile(r"\s+")